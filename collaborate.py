@@ -5,6 +5,7 @@
 import argparse
 from keras.models import load_model
 from neurowriter.encoding import loadencoding
+from neurowriter.models import CUSTOMOBJECTS
 from neurowriter.writer import Writer
 from neurowriter.encoding import END
 
@@ -15,7 +16,7 @@ def collaborate(modelname, encodername, creativity):
     encoder = loadencoding(encodername)
 
     # Load pre-trained model
-    model = load_model(modelname)
+    model = load_model(modelname, custom_objects=CUSTOMOBJECTS)
 
     # Text generation loop
     writer = Writer(model, encoder, creativity=creativity, batchsize=1,
@@ -7,6 +7,7 @@
 import argparse
 from keras.models import load_model
 from neurowriter.encoding import loadencoding
+from neurowriter.models import CUSTOMOBJECTS
 from neurowriter.writer import Writer
 from neurowriter.encoding import END
 
@@ -17,7 +18,7 @@ def generate(modelname, encodername, seed, creativity, maxtokens=None):
     encoder = loadencoding(encodername)
 
     # Load pre-trained model
-    model = load_model(modelname)
+    model = load_model(modelname, custom_objects=CUSTOMOBJECTS)
 
     # Text generation
     print("Seed:", seed)
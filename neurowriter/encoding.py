@@ -114,6 +114,9 @@ class Encoder:
 
     def patterngenerator(self, corpus, tokensperpattern, **kwargs):
         """Infinite generator of encoded patterns.
+
+        Each pattern is made of the indexes of the input tokens, and the index of the token to predict
+        (suitable for sparse categorical losses).
         
         Arguments
             - corpus: iterable of strings making up the corpus
@@ -136,8 +139,7 @@ class Encoder:
             for i in range(tokensperpattern, len(tokens)):
                 x = self.encodetokens(tokens[i-tokensperpattern:i], **kwargs)
                 yindex = self.encodetokens([tokens[i]], **kwargs)[0]
-                y = np.zeros(self.nchars)
-                y[yindex] = 1.0
+                y = np.array([yindex])
                 yield x, y
 
     def save(self, filename):
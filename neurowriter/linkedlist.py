@@ -6,6 +6,8 @@ Python implementation of a doubly linked list.
 @author: Álvaro Barbero Jiménez
 """
 
+import numpy as np
+
 
 class LinkedList:
     """Implementation of a doubly linked list"""
@@ -58,3 +60,63 @@ class LinkedListNode:
 
     def __str__(self):
         return str(self.value)
+
+
+class ArenaList:
+    """Collection of doubly linked lists of integers, stored in a contiguous arena
+
+    Instead of node objects, nodes are positions in three int32 arrays: values, with the value of each node,
+    and nxt and prev, with the positions of the next and previous nodes in the same list, or -1 at the list
+    ends. Nodes removed by merges are marked with a value of -1. As merges only remove nodes, iterating
+    the live positions in increasing order goes over each list from head to tail, one list after another.
+    """
+    def __init__(self, values, lengths=None):
+        """Initializes the lists from the concatenation of the values of all lists
+
+        Arguments:
+            values: iterable with the (non-negative) values of all lists, one list after another
+            lengths: iterable with the length of each list. If not provided, all values are taken as a single list
+        """
+        self.values = np.array(values, dtype=np.int32)
+        if lengths is None:
+            lengths = [len(self.values)]
+        lengths = np.array(lengths, dtype=np.int64)
+        if lengths.sum() != len(self.values):
+            raise ValueError("Lengths of lists do not match the number of values")
+        self.nxt = np.arange(1, len(self.values) + 1, dtype=np.int32)
+        self.prev = np.arange(-1, len(self.values) - 1, dtype=np.int32)
+        lengths = lengths[lengths > 0]
+        ends = np.cumsum(lengths)
+        self.nxt[ends - 1] = -1
+        self.prev[ends - lengths] = -1
+
+    def iternodes(self):
+        """Iterates along the positions of the live nodes, for each list from head to tail"""
+        for i in np.flatnonzero(self.values >= 0):
+            yield int(i)
+
+    def mergewithnext(self, i, value):
+        """Merges the node at position i with its next node, giving it a new value"""
+        j = self.nxt[i]
+        if j < 0:
+            raise ValueError("Node does not have a next node")
+        self.values[i] = value
+        self.values[j] = -1
+        self.nxt[i] = self.nxt[j]
+        if self.nxt[i] >= 0:
+            self.prev[self.nxt[i]] = i
+
+    def __iter__(self):
+        """Iterates along the values of the live nodes, for each list from head to tail"""
+        for i in self.iternodes():
+            yield int(self.values[i])
+
+    def __len__(self):
+        """Number of live nodes"""
+        return int(np.count_nonzero(self.values >= 0))
+
+    def __str__(self):
+        return str([x for x in self])
+
+    def __repr__(self):
+        return self.__str__()
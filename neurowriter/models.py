@@ -13,15 +13,29 @@ host, model parallelization is performed for faster training.
 
 from keras.models import Sequential, Model
 from keras.layers import Conv1D, MaxPooling1D, Dense, Flatten, Input, Dropout, Activation, GlobalMaxPool1D, CuDNNLSTM
-from keras.layers import add, multiply, concatenate
+from keras.layers import LSTM
+from keras.layers import add, Layer
 from keras.layers.embeddings import Embedding
-from keras.layers.core import Lambda
 from keras.layers.wrappers import Bidirectional
 from keras.layers.normalization import BatchNormalization
+from keras.utils import multi_gpu_model
+from keras.engine.saving import preprocess_weights_for_loading
+from keras import backend
 import tensorflow as tf
 from tensorflow.python.client import device_lib
+from tensorflow.core.protobuf import rewriter_config_pb2
+from contextlib import ExitStack
+import numpy as np
+import os
 import re
 
+from neurowriter.symbols import START, NULL
+
+# Environment variable that activates XLA compilation of the models supporting it
+XLAENV = "NEUROWRITER_XLA"
+# Environment variable that activates automatic mixed precision training
+MIXEDPRECISIONENV = "NEUROWRITER_MIXEDPRECISION"
+
 
 def get_available_gpus():
     """Returns a list of the GPU devices found in the host
@@ -33,71 +47,66 @@ def get_available_gpus():
     return [x.name for x in local_device_protos if x.device_type == 'GPU']
 
 
-def make_parallel(model, gpu_count):
-    """Makes a keras model data-parallel on a set of gpus
-    
-    Original code extracted from
-        https://github.com/kuza55/keras-extras/blob/master/utils/multi_gpu.py
-    
-    Modifications by Álvaro Barbero.
+def mixedprecisionenabled():
+    """Checks whether automatic mixed precision training has been requested through the environment"""
+    return os.environ.get(MIXEDPRECISIONENV) == "1"
+
+
+def xlaenabled(xla=True):
+    """Checks whether XLA compilation is to be used, for a model supporting it or not
+
+    XLA is used for models supporting it if the NEUROWRITER_XLA environment variable is set to 1.
     """
-    if gpu_count <= 1:
-        raise ValueError("At least 2 GPUs are required to make the model parallel")
+    return xla and os.environ.get(XLAENV) == "1"
 
-    outputs_all = []
-    for i in range(len(model.outputs)):
-        outputs_all.append([])
 
-    # Place a copy of the model on each GPU, each getting a slice of the batch
-    for i in range(gpu_count):
-        with tf.device('/gpu:%d' % i):
-            with tf.name_scope('tower_%d' % i):
+def configure_session(xla=True):
+    """Replaces the keras session with one using the graph optimizations requested through the environment
 
-                inputs = []
-                # Slice each input into a piece for processing on this GPU
-                for x in model.inputs:
-                    input_shape = tuple(x.get_shape().as_list())[1:]
-                    slice_n = Lambda(tensorslice, output_shape=input_shape, arguments={'idx':i,'parts':gpu_count})(x)
-                    inputs.append(slice_n)                
+    Available optimizations are
+        - XLA compilation, activated by setting the NEUROWRITER_XLA environment variable to 1. XLA fuses
+          chains of small element-wise operations into single kernels, but can also be slower than standard
+          kernels for some convolutions.
+        - Automatic mixed precision, activated by setting the NEUROWRITER_MIXEDPRECISION environment variable
+          to 1. Matrix products and convolutions are rewritten to run in float16 on the GPU tensor cores,
+          while weights and numerically sensitive operations such as softmax are kept in float32. The
+          optimizer must apply loss scaling so small gradients do not underflow, as trainmodel does.
 
-                outputs = model(inputs)
-                
-                if not isinstance(outputs, list):
-                    outputs = [outputs]
-                
-                # Save all the outputs for merging back together later
-                for l in range(len(outputs)):
-                    outputs_all[l].append(outputs[l])
-
-    # merge outputs on CPU
-    with tf.device('/cpu:0'):
-        if gpu_count > 1:
-            merged = []
-            for outputs in outputs_all:
-                merged.append(concatenate(outputs, axis=0))
-        else:
-            merged = outputs
-            
-        return Model(inputs=model.inputs, outputs=merged)
+    Arguments:
+        xla: whether the model to build supports XLA compilation. If not, the new session has XLA disabled
+            even if requested through the environment.
+
+    Nothing is done if no optimization is requested. Else the current session is closed and the graph cleared,
+    so models previously built can no longer be used. Must be called before building the model, as trainmodel
+    does.
+    """
+    usemixed = mixedprecisionenabled()
+    if not (os.environ.get(XLAENV) == "1" or usemixed):
+        return
+    config = tf.ConfigProto()
+    if xlaenabled(xla):
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    if usemixed:
+        config.graph_options.rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+    backend.get_session().close()
+    backend.clear_session()
+    backend.set_session(tf.Session(config=config))
 
 
-def tensorslice(data, idx, parts):
-    """Slices a tensor of data into several parts, as equal as possible.
-    
-    Inputs:
-        data: input data flow
-        idx: index of the slice to extract
-        parts: number of pieces in which to partition the data
-       
-    If the number of data patterns is smaller than parts, some slices will
-    be empty.
+def make_parallel(model, gpu_count):
+    """Makes a keras model data-parallel on a set of gpus
+
+    A replica of the whole model is placed on each GPU, each getting a slice of the batch, and
+    outputs are merged back on CPU. Keeping each replica within a single device avoids moving
+    intermediate activations between GPUs.
+
+    Keras recommends building the template model under tf.device('/cpu:0'), so its weights are
+    kept in host memory rather than on the first GPU. The models in this module are built under
+    the default device placement.
     """
-    shape = tf.shape(data)
-    startidx = shape[:1] * idx // parts
-    endidx = shape[:1] * (idx+1) // parts
-    start = tf.concat([startidx, shape[1:]*0], axis=0)
-    size = tf.concat([endidx-startidx, shape[1:]], axis=0)
-    return tf.slice(data, start, size)
+    if gpu_count <= 1:
+        raise ValueError("At least 2 GPUs are required to make the model parallel")
+    return multi_gpu_model(model, gpus=gpu_count)
 
 
 def getcoremodel(model):
@@ -112,11 +121,26 @@ def getcoremodel(model):
     raise ValueError("Core model not found")
 
 
+def lstmlayer(units, cudnn, **kwargs):
+    """Creates an LSTM layer, using the fused cuDNN implementation whenever possible
+
+    The cuDNN implementation is used if cudnn is True, which should be the case if GPUs are available. Else a
+    standard LSTM layer with cuDNN-compatible gates is returned, so weights can be exchanged with cuDNN layers.
+
+    Any additional keyword arguments are passed on to the layer.
+    """
+    if cudnn:
+        return CuDNNLSTM(units, **kwargs)
+    return LSTM(units, recurrent_activation='sigmoid', **kwargs)
+
+
 class ModelMixin:
     """Abstract class defining a text generation model"""
 
     # List of hyperparameter ranges for this model
     paramgrid = []
+    # Whether the model supports XLA compilation
+    xla = False
 
     @staticmethod
     def trim(model):
@@ -148,6 +172,7 @@ class DilatedConvModel(ModelMixin):
         (0.0, 1.0),  # densedrop
         [32, 64, 128, 256, 512],  # size of the embedding
     ]
+    xla = True
 
     @staticmethod
     def create(inputtokens, vocabsize, convlayers=5, kernels=32,
@@ -188,33 +213,80 @@ class DilatedConvModel(ModelMixin):
         return model
 
 
-def gatedblock(dilation, dropout, kernels, kernel_size):
+def jitscope(enabled):
+    """Context manager marking the operations created within for XLA compilation, if enabled"""
+    if enabled:
+        return tf.xla.experimental.jit_scope()
+    return ExitStack()
+
+
+class GatedMerge(Layer):
+    """Keras layer merging the branches of a gated block and its residual connection
+
+    Computes the gated activation tanh(normal) · sigmoid(gate), followed by a point-wise projection with
+    tanh activation (the skip output), and adds the block input to it (the block output). All these
+    operations are done within a single layer, so that they are compiled as a single XLA cluster when
+    XLA is active, and intermediate tensors are not materialized.
+
+    Inputs are [normal branch, gate branch, block input], the branches before activation.
+    Outputs are [block output, skip output].
+
+    The xla argument must match the XLA setting of the session, as given by xlaenabled. It is not saved with
+    the model, so loaded models run without XLA, as the default session.
+    """
+
+    def __init__(self, kernels, xla=False, **kwargs):
+        super().__init__(**kwargs)
+        self.kernels = kernels
+        self.xla = xla
+
+    def build(self, input_shape):
+        self.kernel = self.add_weight(name='kernel', shape=(input_shape[0][-1], self.kernels),
+                                      initializer='glorot_uniform')
+        self.bias = self.add_weight(name='bias', shape=(self.kernels,), initializer='zeros')
+        super().build(input_shape)
+
+    def call(self, inputs):
+        normal, gate, residual = inputs
+        with jitscope(self.xla):
+            merged = backend.tanh(normal) * backend.sigmoid(gate)
+            skip = backend.tanh(backend.bias_add(backend.dot(merged, self.kernel), self.bias))
+            return [skip + residual, skip]
+
+    def compute_output_shape(self, input_shape):
+        shape = tuple(input_shape[0][:-1]) + (self.kernels,)
+        return [shape, shape]
+
+    def get_config(self):
+        config = super().get_config()
+        config['kernels'] = self.kernels
+        return config
+
+
+def gatedblock(dilation, dropout, kernels, kernel_size, xla=False):
     """Keras compatible Dilated convolution layer
 
-    Includes Gated activation, skip connections, batch normalization and dropout
+    Includes Gated activation, skip connections, batch normalization and dropout. The gated activation is
+    marked for XLA compilation if xla is True.
     """
 
     def f(input_):
         norm = BatchNormalization()(input_)
         # Dropout of inputs
         drop = Dropout(dropout)(norm)
-        # Normal activation
-        normal_out = Conv1D(kernels, kernel_size, dilation_rate=dilation, activation='tanh', padding='same')(drop)
+        # Normal branch
+        normal_out = Conv1D(kernels, kernel_size, dilation_rate=dilation, padding='same')(drop)
         # Gate
-        gate_out = Conv1D(kernels, kernel_size, dilation_rate=dilation, activation='sigmoid', padding='same')(drop)
-        # Point-wise nonlinear · gate
-        merged = multiply([normal_out, gate_out])
-        # Activation after gate
-        skip_out = Conv1D(kernels, 1, activation='tanh')(merged)
-        # Residual connections: allow the network input to skip the
-        # whole block if necessary
-        out = add([skip_out, input_])
+        gate_out = Conv1D(kernels, kernel_size, dilation_rate=dilation, padding='same')(drop)
+        # Point-wise nonlinear · gate, activation after gate, and residual connections
+        # allowing the network input to skip the whole block if necessary
+        out, skip_out = GatedMerge(kernels, xla=xla)([normal_out, gate_out, input_])
         return out, skip_out
 
     return f
 
 
-def wavenetblock(maxdilation, dropout, kernels, kernel_size):
+def wavenetblock(maxdilation, dropout, kernels, kernel_size, xla=False):
     """Keras compatible Wavenet layer
 
     A Wavenet layer is made of a stack of gated blocks with exponentially increasing dilations
@@ -225,7 +297,7 @@ def wavenetblock(maxdilation, dropout, kernels, kernel_size):
         skip_connections = []
         # Increasing dilation rates
         while dilation < maxdilation:
-            flow, skip = gatedblock(dilation, dropout, kernels, kernel_size)(flow)
+            flow, skip = gatedblock(dilation, dropout, kernels, kernel_size, xla)(flow)
             skip_connections.append(skip)
             dilation *= 2
         skip = add(skip_connections)
@@ -259,11 +331,14 @@ class WavenetModel(ParallelGpuModel):
         (0.0, 1.0),  # dropout
         [32, 64, 128, 256, 512]  # size of the embedding
     ]
+    xla = True
 
     @staticmethod
     def create(inputtokens, vocabsize, kernels=64, wavenetblocks=1, dropout=0, embedding=32):
         kernel_size = 7
         maxdilation = inputtokens
+        # Same XLA setting as the session configured for this model
+        xla = xlaenabled(WavenetModel.xla)
         
         input_ = Input(shape=(inputtokens,), dtype='int32')
         # Embedding layer
@@ -271,17 +346,18 @@ class WavenetModel(ParallelGpuModel):
         net = Dropout(dropout)(net)
         # Wavenet starts!
         net = BatchNormalization()(net)
-        net = Conv1D(kernels, 1, activation='tanh')(net)
+        # Point-wise projections are done as Dense layers over the last axis, equivalent to 1x1 convolutions
+        net = Dense(kernels, activation='tanh')(net)
         skip_connections = []
         for i in range(wavenetblocks):
-            net, skip = wavenetblock(maxdilation, dropout, kernels, kernel_size)(net)
+            net, skip = wavenetblock(maxdilation, dropout, kernels, kernel_size, xla)(net)
             skip_connections.append(skip)
         if wavenetblocks > 1:
             net = add(skip_connections)
         else:
             net = skip
-        net = Conv1D(kernels, 1, activation='tanh')(net)
-        net = Conv1D(kernels, 1)(net)
+        net = Dense(kernels, activation='tanh')(net)
+        net = Dense(kernels)(net)
         net = Flatten()(net)
         net = Dense(vocabsize, activation='softmax')(net)
         model = Model(inputs=input_, outputs=net)
@@ -324,7 +400,9 @@ class StackedLSTMModel(ParallelGpuModel):
 
     @staticmethod
     def create(inputtokens, vocabsize, layers=1, units=16, dropout=0, embedding=32):
-        
+        # Available GPUs, checked once for all layers
+        ngpus = len(get_available_gpus())
+
         input_ = Input(shape=(inputtokens,), dtype='int32')
         
         # Embedding layer
@@ -333,19 +411,19 @@ class StackedLSTMModel(ParallelGpuModel):
             
         # Bidirectional LSTM layer
         net = BatchNormalization()(net)
-        net = Bidirectional(CuDNNLSTM(units, return_sequences=(layers > 1)))(net)
+        net = Bidirectional(lstmlayer(units, ngpus > 0, return_sequences=(layers > 1)))(net)
         net = Dropout(dropout)(net)
             
         # Rest of LSTM layers with residual connections (if any)
         for i in range(1, layers):
             if i < layers-1:
                 block = BatchNormalization()(net)
-                block = CuDNNLSTM(2*units, return_sequences=True)(block)
+                block = lstmlayer(2*units, ngpus > 0, return_sequences=True)(block)
                 block = Dropout(dropout)(block)
                 net = add([block, net])
             else:
                 net = BatchNormalization()(net)
-                net = CuDNNLSTM(2*units)(net)
+                net = lstmlayer(2*units, ngpus > 0)(net)
                 net = Dropout(dropout)(net)
                     
         # Output layer
@@ -353,7 +431,6 @@ class StackedLSTMModel(ParallelGpuModel):
         model = Model(inputs=input_, outputs=net)
         
         # Make data-parallel
-        ngpus = len(get_available_gpus())
         if ngpus > 1:
             model = make_parallel(model, ngpus)
 
@@ -377,6 +454,8 @@ class LSTMModel(ModelMixin):
 
     @staticmethod
     def create(inputtokens, vocabsize, units=16, dropout=0, embedding=32):
+        # Available GPUs, checked once for all layers
+        ngpus = len(get_available_gpus())
 
         input_ = Input(shape=(inputtokens,), dtype='int32')
 
@@ -386,7 +465,7 @@ class LSTMModel(ModelMixin):
 
         # Bidirectional LSTM layer
         net = BatchNormalization()(net)
-        net = Bidirectional(CuDNNLSTM(units))(net)
+        net = Bidirectional(lstmlayer(units, ngpus > 0))(net)
         net = Dropout(dropout)(net)
 
         # Output layer
@@ -394,7 +473,6 @@ class LSTMModel(ModelMixin):
         model = Model(inputs=input_, outputs=net)
 
         # Make data-parallel
-        ngpus = len(get_available_gpus())
         if ngpus > 1:
             model = make_parallel(model, ngpus)
 
@@ -432,6 +510,8 @@ class CNNLSTMModel(ModelMixin):
     @staticmethod
     def create(inputtokens, vocabsize, convlayers=3, kernels=512, kernelsize=5, convdropout=0.5, lstmunits=256,
                lstmdropout=0.1, embedding=512, embdropout=0.5):
+        # Available GPUs, checked once for all layers
+        ngpus = len(get_available_gpus())
 
         input_ = Input(shape=(inputtokens,), dtype='int32')
 
@@ -447,7 +527,7 @@ class CNNLSTMModel(ModelMixin):
             net = Dropout(convdropout)(net)
 
         # Bidirectional LSTM layer
-        net = Bidirectional(CuDNNLSTM(lstmunits))(net)
+        net = Bidirectional(lstmlayer(lstmunits, ngpus > 0))(net)
         net = Dropout(lstmdropout)(net)
 
         # Output layer
@@ -455,7 +535,6 @@ class CNNLSTMModel(ModelMixin):
         model = Model(inputs=input_, outputs=net)
 
         # Make data-parallel
-        ngpus = len(get_available_gpus())
         if ngpus > 1:
             model = make_parallel(model, ngpus)
 
@@ -485,6 +564,129 @@ class PerceptronModel(ModelMixin):
         model.add(Dense(vocabsize, activation='softmax'))
         return model
 
+
+def calibrationpatterns(encoder, corpus, inputtokens, samples=100):
+    """Generates input patterns evenly spread over the whole corpus, for calibrating quantized activations
+
+    Patterns made mostly of padding, as those at the start of every document, are skipped unless the corpus
+    has no other patterns.
+
+    Arguments:
+        encoder: encoder used to transform the corpus into patterns
+        corpus: corpus to take patterns from
+        inputtokens: number of input tokens per pattern
+        samples: number of patterns to generate
+
+    The corpus is tokenized once, and the selected patterns are built directly from the tokenized documents.
+    """
+    tokenizedcorpus = [encoder.tokenizer.transform(doc) for doc in corpus]
+    # The pattern predicting the t-th token of a document (or its END) has max(0, inputtokens - t) padding tokens,
+    # so patterns with t below first are mostly padding
+    lengths = np.array([len(tokens) + 1 for tokens in tokenizedcorpus])
+    first = inputtokens // 2 + 1
+    counts = np.maximum(lengths - first, 0)
+    if counts.sum() == 0:
+        print("Warning: all corpus patterns are mostly padding, calibrating with them anyway")
+        first = 0
+        counts = lengths
+    # Take patterns at regular intervals
+    ends = np.cumsum(counts)
+    total = int(ends[-1]) if len(ends) else 0
+    stride = max(1, total // samples)
+    for k in range(0, min(total, stride * samples), stride):
+        doc = int(np.searchsorted(ends, k, side='right'))
+        t = first + k - int(ends[doc] - counts[doc])
+        tokens = [NULL] * (inputtokens - 1) + [START] + tokenizedcorpus[doc]
+        yield encoder.encodetokens(tokens[t:t + inputtokens])[np.newaxis]
+
+
+def _inferenceconfig(config):
+    """Adapts a model config for inference with TensorFlow Lite
+
+    cuDNN LSTM layers are replaced by standard LSTM layers with cuDNN-compatible gates, and all LSTM layers are
+    unrolled, as TensorFlow Lite supports neither cuDNN kernels nor the loops of recurrent layers.
+    """
+    if isinstance(config, list):
+        return [_inferenceconfig(item) for item in config]
+    if not isinstance(config, dict):
+        return config
+    config = {key: _inferenceconfig(value) for key, value in config.items()}
+    if config.get('class_name') == 'CuDNNLSTM':
+        config['class_name'] = 'LSTM'
+        config['config'] = dict(config['config'], activation='tanh', recurrent_activation='sigmoid')
+    if config.get('class_name') == 'LSTM':
+        config['config'] = dict(config['config'], unroll=True)
+    return config
+
+
+def _iscudnn(layer):
+    """Checks whether a layer is a cuDNN LSTM layer, or wraps one"""
+    return isinstance(layer, CuDNNLSTM) or isinstance(getattr(layer, 'layer', None), CuDNNLSTM)
+
+
+def inferencemodel(model):
+    """Rebuilds a trained model for inference
+
+    The keras session is cleared and the learning phase is fixed to inference, so dropout and other training-only
+    operations are left out of the new graph. cuDNN LSTM layers are replaced by standard LSTM layers, converting
+    their weights, and recurrent layers are unrolled.
+
+    The given model cannot be used after calling this function. Data-parallel models must be trimmed first.
+    """
+    if any(isinstance(layer, Model) for layer in model.layers):
+        raise ValueError("Data-parallel models must be trimmed before rebuilding them for inference")
+    config = _inferenceconfig(model.get_config())
+    layers = [(layer.name, _iscudnn(layer), layer.get_weights()) for layer in model.layers]
+    backend.clear_session()
+    backend.set_learning_phase(0)
+    inference = model.__class__.from_config(config, custom_objects=CUSTOMOBJECTS)
+    for layer, (name, cudnn, weights) in zip(inference.layers, layers):
+        try:
+            layer.set_weights(preprocess_weights_for_loading(layer, weights))
+        except ValueError as e:
+            if cudnn:
+                raise ValueError("cuDNN LSTM layer %s could not be converted to a standard LSTM layer: %s" % (name, e))
+            raise
+    return inference
+
+
+def quantize(model, encoder, corpus, samples=100):
+    """Converts a trained model to an int8 quantized TensorFlow Lite model, for faster inference on CPU
+
+    Weights and activations are quantized to 8 bit integers. Activation ranges are calibrated over a
+    representative set of patterns sampled throughout the training corpus. The model input (token indexes) and
+    the output (token probabilities) are kept in their original types.
+
+    The model is first rebuilt for inference with inferencemodel, so it cannot be used after calling this function.
+
+    Arguments:
+        model: trained keras model
+        encoder: encoder used to transform the corpus into patterns for the model
+        corpus: training corpus
+        samples: number of patterns to use for calibration
+
+    Returns the quantized model as a TensorFlow Lite flatbuffer (bytes)
+    """
+    model = inferencemodel(model)
+    inputtokens = model.input_shape[1]
+    inputtype = model.inputs[0].dtype.as_numpy_dtype
+
+    def representative_dataset():
+        for X in calibrationpatterns(encoder, corpus, inputtokens, samples):
+            yield [X.astype(inputtype)]
+
+    converter = tf.lite.TFLiteConverter.from_session(backend.get_session(), model.inputs, model.outputs)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+
+"""Dictionary of custom layers, required for loading saved models"""
+CUSTOMOBJECTS = {
+    "GatedMerge": GatedMerge,
+}
+
 """Dictionary of model architectures indexed by a string"""
 MODELSBYNAME = {
     "dilatedconv": DilatedConvModel,
@@ -17,10 +17,14 @@ from keras import backend
 from tempfile import NamedTemporaryFile
 import pickle as pkl
 
+from neurowriter.models import CUSTOMOBJECTS, configure_session, mixedprecisionenabled
+
 # Loss to account for failed hyperoptmimization trials
 FAILEDTRIALLOSS = 1000
 # Number of random trials at the start of the hyperoptimization
 RANDOMTRIALS = 10
+# Static loss scale used when training with mixed precision
+LOSSSCALE = 128
 
 # Optimizer parameters
 OPTPARAMS = {
@@ -45,6 +49,23 @@ def optimizerbyname(optname):
     return optimizers[normalized]
 
 
+def lossscaled(optimizer, scale=LOSSSCALE):
+    """Applies static loss scaling to a keras optimizer
+
+    The loss is multiplied by the scale before computing the gradients, and the gradients are divided by it
+    afterwards, so that small gradients do not underflow when computed in float16 by mixed precision training.
+
+    Returns the same optimizer, modified.
+    """
+    getgradients = optimizer.get_gradients
+
+    def scaledgradients(loss, params):
+        return [grad / scale for grad in getgradients(loss * scale, params)]
+
+    optimizer.get_gradients = scaledgradients
+    return optimizer
+
+
 def trainmodel(modelclass, inputtokens, encoder, corpus, maxepochs=1000, valmask=None, patience=10, batchsize=256,
                optimizerclass=Adam, learningrate=None, verbose=1, modelparams=[]):
     """Trains a keras model with given parameters
@@ -68,12 +89,15 @@ def trainmodel(modelclass, inputtokens, encoder, corpus, maxepochs=1000, valmask
         print("Training with inputtokens=%d, batchsize=%d, optimizer=%s, learningrate=%f, modelparams=%s" %
               (inputtokens, batchsize, str(optimizerclass), learningrate, str(modelparams)))
 
-    # Build model with input parameters
+    # Prepare session with the requested graph optimizations, and build model with input parameters
+    configure_session(xla=modelclass.xla)
     model = modelclass.create(inputtokens, encoder.nchars, *modelparams)
-    # Prepare optimizer
+    # Prepare optimizer, with loss scaling if training with mixed precision
     optimizer = optimizerclass(lr=learningrate)
+    if mixedprecisionenabled():
+        optimizer = lossscaled(optimizer)
     # Compile model with optimizer
-    model.compile(optimizer=optimizer, loss='categorical_crossentropy', metrics=['accuracy'])
+    model.compile(optimizer=optimizer, loss='sparse_categorical_crossentropy', metrics=['accuracy'])
 
     # Prepare masks
     if valmask is not None:
@@ -247,7 +271,7 @@ def findbestparams(modelclass, encoder, corpus, modelsfolder, n_calls=100, verbo
     # Recover best parameters, best loss, best model
     bestparams = optres.x
     bestloss = optres.fun
-    bestmodel = load_model(modelsfolder + "/" + loss2modelname(bestloss))
+    bestmodel = load_model(modelsfolder + "/" + loss2modelname(bestloss), custom_objects=CUSTOMOBJECTS)
 
     return bestparams, bestloss, bestmodel, optres
 
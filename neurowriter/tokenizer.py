@@ -13,9 +13,57 @@ method.
 
 import re
 import collections
-from itertools import chain
+import heapq
+from itertools import count
 
-from neurowriter.linkedlist import LinkedList
+import numpy as np
+
+from neurowriter.linkedlist import ArenaList
+
+# Optional, only speeds up SubwordTokenizer.longestmatch and bestmatch, as fitted subword tokenizers transform texts
+# by replaying their merges
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+try:
+    from numba import njit
+    NUMBA = True
+except ImportError:
+    NUMBA = False
+
+    def njit(*args, **kwargs):
+        """Replacement for numba's njit decorator when numba is not available: functions run as plain python"""
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+# Expression matching word characters
+_WORD_RE = re.compile(r"\w")
+# Words and single non-word characters
+_WORDS_RE = re.compile(r"\w+|\W")
+# Maximum number of words whose symbols are cached by the subword tokenizer
+_WORDCACHESIZE = 2**16
+# Minimum number of corpus symbols for computing pair statistics in GPU
+_GPUMINSYMBOLS = 2**24
+# Bits used to represent each symbol id when packing pairs of symbols in a single integer
+_PAIRBITS = 20
+
+
+def _codepoints(text):
+    """Returns an array with the unicode codepoints of the characters in a text"""
+    return np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+
+
+def _charset(corpus):
+    """Returns the set of characters appearing in a corpus of documents"""
+    return set(map(chr, np.flatnonzero(np.bincount(_codepoints("".join(corpus)))).tolist()))
 
 
 class CharTokenizer:
@@ -50,15 +98,16 @@ class WordTokenizer:
         self.minfreq = minfreq
         self.symbols = None
         # Precompile parsing expression
-        self.parser = re.compile('(\W)')
+        self.parser = re.compile(r'(\W)')
     
     def fit(self, corpus):
         # First add all basic characters to the dictionary
-        self.symbols = set(chain(*[doc for doc in corpus]))
-        # Split input in words, get unique tokens and counts
-        tokens = collections.Counter(
-            chain(*[self.parser.split(doc) for doc in corpus])
-        )
+        self.symbols = _charset(corpus)
+        # Split input in words, get unique tokens and counts, one document at a time
+        tokens = collections.Counter()
+        split = self.parser.split
+        for doc in corpus:
+            tokens.update(split(doc))
         # Filter out unfrequent symbols
         freqsymbols = [(symbol, freq) for symbol, freq in tokens.items() 
                         if freq >= self.minfreq]
@@ -116,6 +165,26 @@ class SubwordTokenizer:
         self.crosswords = crosswords
         self.symbols = None
         self.detector = None
+        self.automaton = None
+        # Merge operations, in the order they were applied while fitting
+        self.merges = None
+        self.mergerank = None
+        # Parts each composite symbol was first built from
+        self._mergeparts = None
+        # Symbols found for each word already transformed
+        self._wordcache = {}
+        # Symbol ids, used while fitting
+        self._id2symbol = None
+        self._symbol2id = None
+        self._joinable = None
+        # Number of occurrences of each symbol in the corpus, used while fitting
+        self._symbolcounts = None
+        # Cache of characters that are word characters
+        self._wordchar_cache = {}
+        # Heap of pair frequencies, used while fitting
+        self._heap = None
+        self._pairorder = None
+        self._ordercounter = None
 
     def validpair(self, s1, s2):
         """Checks that a pair a symbols is valid for joining
@@ -126,32 +195,48 @@ class SubwordTokenizer:
         # If crosswords option is active, we can join anything
         if self.crosswords:
             return True
-        # Else, if both are already a composite symbol, it's ok to join
-        elif len(s1) > 1 and len(s2) > 1:
-            return True
-        # If any of them are characters, check that both are valid word symbols
+        # Else, each symbol must be either a composite symbol or a word character
         else:
-            return (len(s1) > 1 or re.match("\w", s1)) and (len(s2) > 1 or re.match("\w", s2))
+            return self._iswordsymbol(s1) and self._iswordsymbol(s2)
+
+    def _iswordsymbol(self, symbol):
+        """Checks whether a symbol is a composite symbol or a word character
+
+        Results for single characters are cached, to avoid running the regular expression over and over.
+        """
+        if len(symbol) > 1:
+            return True
+        if symbol not in self._wordchar_cache:
+            self._wordchar_cache[symbol] = bool(_WORD_RE.match(symbol))
+        return self._wordchar_cache[symbol]
 
     def pairfreqs(self, corpus):
         """Computes symbol pair statistics over a corpus
 
-        The input must be a list of docs, each a LinkedList of symbols.
+        The input must be an ArenaList with a linked list of symbol ids per document, as built by the fit method.
         Statistics over words won't be accounted for if the crosswords options is disabled.
+
+        Returns a dictionary of pair frequencies, indexed by pairs of symbols and sorted by first appearance.
+
+        Statistics are computed in GPU for large corpora if cupy is available. Else a compiled kernel is used if
+        numba is available, or vectorized numpy operations if not.
         """
-        stats = collections.defaultdict(int)
-        for doc in corpus:
-            for node in doc.iternodes():
-                # Only account for non-word symbols of crosswords option is active
-                if node.nxt is not None and self.validpair(node.value, node.nxt.value):
-                    stats[node.value, node.nxt.value] += 1
-        return stats
+        if cupy is not None and len(corpus.values) >= _GPUMINSYMBOLS and len(self._id2symbol) < 2**_PAIRBITS:
+            lefts, rights, counts = (cupy.asnumpy(x) for x in _pair_freqs_packed(
+                cupy, cupy.asarray(corpus.values), cupy.asarray(corpus.nxt), cupy.asarray(self._joinable)))
+        elif not NUMBA and len(self._id2symbol) < 2**_PAIRBITS:
+            lefts, rights, counts = _pair_freqs_packed(np, corpus.values, corpus.nxt, self._joinable)
+        else:
+            lefts, rights, counts = _pair_freqs(corpus.values, corpus.nxt, self._joinable)
+        id2symbol = self._id2symbol
+        pairs = zip([id2symbol[left] for left in lefts.tolist()], [id2symbol[right] for right in rights.tolist()])
+        return collections.defaultdict(int, zip(pairs, counts.tolist()))
 
     def mergesymbols(self, corpus, symbols, freqs, leftsymbol, rightsymbol):
         """Merges two symbols in the encoding
 
         Arguments:
-            - corpus: current list of docs, each a LinkedList of symbols
+            - corpus: current corpus, as an ArenaList of symbol ids
             - symbols: current set of symbols
             - freqs: current symbol pairs statistics
             - leftsymbol, rightsymbol: symbols to merge
@@ -161,77 +246,142 @@ class SubwordTokenizer:
             - new list of symbols
             - updated symbol pair statistics
         """
-        # Add new symbol to set
+        # Add new symbol to set, and record the merge operation
         newsymbol = leftsymbol + rightsymbol
         self.symbols.add(newsymbol)
-
-        # Go over each doc in corpus, find occurrences of the given pair and merge
-        for doc in corpus:
-            for node in doc.iternodes():
-                if node.value == leftsymbol and node.nxt is not None and node.nxt.value == rightsymbol:
-                    node.mergewithnext()
-                    # Update frequencies with previous symbol
-                    if node.prev is not None and self.validpair(node.prev.value, newsymbol):
-                        prevsymbol = node.prev.value
-                        freqs[prevsymbol, newsymbol] += 1
-                        freqs[prevsymbol, leftsymbol] -= 1
-                    # Update frequencies with next symbol
-                    if node.nxt is not None and self.validpair(node.nxt.value, newsymbol):
-                        nextsymbol = node.nxt.value
-                        freqs[newsymbol, nextsymbol] += 1
-                        freqs[rightsymbol, nextsymbol] -= 1
+        self.merges.append((leftsymbol, rightsymbol))
+        newid = self._symbolid(newsymbol)
+
+        # Merge all occurrences of the given pair in the corpus, and get changes in neighbouring pairs statistics
+        nmerges, lefts, rights, deltas = _merge_pair(corpus.values, corpus.nxt, corpus.prev,
+                                                     self._symbol2id[leftsymbol], self._symbol2id[rightsymbol], newid,
+                                                     self._joinable)
+        self._symbolcounts[newsymbol] += nmerges
+        self._symbolcounts[leftsymbol] -= nmerges
+        self._symbolcounts[rightsymbol] -= nmerges
+        # Add up changes for each pair, keeping pairs in order of first appearance, and update them once
+        id2symbol = self._id2symbol
+        pairdeltas = {}
+        for left, right, delta in zip(lefts.tolist(), rights.tolist(), deltas.tolist()):
+            pair = (id2symbol[left], id2symbol[right])
+            pairdeltas[pair] = pairdeltas.get(pair, 0) + delta
+        for pair, delta in pairdeltas.items():
+            if delta != 0 or pair not in freqs:
+                self._bump(freqs, pair, delta)
 
         # Delete statistics of merged symbols
         del freqs[(leftsymbol, rightsymbol)]
+        del self._pairorder[(leftsymbol, rightsymbol)]
 
         return corpus, freqs, symbols
 
+    def _initheap(self, freqs):
+        """Builds the heap of pair frequencies used to find the most frequent pair
+
+        Heap entries are tuples (-frequency, order, pair), where order is the position of the pair in the frequencies
+        dictionary, so ties are resolved in favour of the pair that was added first.
+        """
+        self._pairorder = {pair: order for order, pair in enumerate(freqs)}
+        self._ordercounter = count(len(self._pairorder))
+        self._heap = [(-freq, order, pair) for order, (pair, freq) in enumerate(freqs.items())]
+        heapq.heapify(self._heap)
+
+    def _bump(self, freqs, pair, delta):
+        """Updates the frequency of a symbol pair, pushing the new frequency to the heap"""
+        if pair not in freqs:
+            self._pairorder[pair] = next(self._ordercounter)
+        freqs[pair] += delta
+        heapq.heappush(self._heap, (-freqs[pair], self._pairorder[pair], pair))
+
+    def _mostfrequentpair(self, freqs):
+        """Returns the most frequent pair of symbols, or None if there are no pairs
+
+        Heap entries no longer matching the current frequencies are discarded along the way.
+        """
+        heap = self._heap
+        while heap:
+            negfreq, order, pair = heap[0]
+            if freqs.get(pair) == -negfreq and self._pairorder.get(pair) == order:
+                return pair
+            heapq.heappop(heap)
+        return None
+
+    def _symbolid(self, symbol):
+        """Returns the numeric id of a symbol, registering it if new"""
+        if symbol not in self._symbol2id:
+            self._symbol2id[symbol] = len(self._id2symbol)
+            self._id2symbol.append(symbol)
+        return self._symbol2id[symbol]
+
     def compile(self):
-        """Compiles the parsing expression for more efficiency"""
-        # Sort symbols by length, so larger symbols have precedence
-        srt = sorted(self.symbols, key=lambda x: len(x), reverse=True)
-        # Escape special symbols
-        srt = [re.escape(token) for token in srt]
-        # Detect any symbol, with precedence for larger ones
-        self.detector = re.compile('|'.join(srt))
-
-    def bestmatch(self, string):
-        """Find the best matching symbol at the beggining of a string"""
-        if self.detector is None:
+        """Compiles the parsing expression for more efficiency
+
+        If the pyahocorasick package is available, an Aho-Corasick automaton matching all symbols in a single
+        pass over the text is built. Else a regular expression is used.
+
+        The automaton only finds the same longest matches as the regular expression if every character used
+        in the symbols is also a symbol by itself. This always holds for fitted tokenizers, but if not the
+        regular expression is used.
+        """
+        if self.symbols is None:
             raise ValueError("Tokenizer has not been fitted")
-        match = self.detector.match(string)
+        if ahocorasick is not None and set("".join(self.symbols)) <= self.symbols:
+            self.detector = None
+            self.automaton = ahocorasick.Automaton()
+            for symbol in self.symbols:
+                self.automaton.add_word(symbol, symbol)
+            self.automaton.make_automaton()
+        else:
+            self.automaton = None
+            # Sort symbols by length, so larger symbols have precedence
+            srt = sorted(self.symbols, key=lambda x: len(x), reverse=True)
+            # Escape special symbols
+            srt = [re.escape(token) for token in srt]
+            # Detect any symbol, with precedence for larger ones
+            self.detector = re.compile('|'.join(srt))
+
+    def bestmatch(self, string, pos=0):
+        """Find the best matching symbol at the given position of a string (by default, its beginning)
+
+        The string is not sliced, so repeated calls over different positions of a long string are cheap.
+        """
+        if self.automaton is None and self.detector is None:
+            self.compile()
+        if self.automaton is not None:
+            # Longest leftmost matches: if some symbol matches at the position, it is the first one
+            for end, symbol in self.automaton.iter_long(string, pos):
+                return symbol if end - len(symbol) + 1 == pos else None
+            return None
+        match = self.detector.match(string, pos)
         if match is not None:
             return match.group()
         else:
             return None
 
-    def prunesymbols(self, corpus):
+    def prunesymbols(self):
         """Removes from the list of symbols those that appear unfrequently in the corpus
 
         This is useful after performing all the merge operations, where some symbols might
         have dissapeared from the corpus aftar being merged with others.
 
-        The provided corpus must be an iterable of documents, each a Linked List of symbols
-        after all merge operations.
+        Symbol frequencies are those of the corpus after all merge operations, as tracked by
+        the merge steps.
 
         Symbols made of 1 character are never removed.
         """
-        # Compute frequencies of the provided corpus
-        freqs = collections.defaultdict(int)
-        for doc in corpus:
-            for symbol in doc:
-                freqs[symbol] += 1
         # Go over the symbols in the tokenizer, remove those with low frequency and more than 1 char
-        self.symbols = {symbol for symbol in self.symbols if len(symbol) == 1 or freqs[symbol] >= self.minfreq}
+        self.symbols = {symbol for symbol in self.symbols
+                        if len(symbol) == 1 or self._symbolcounts[symbol] >= self.minfreq}
 
     def mergingrun(self, corpus, freqs):
         """Performs symbol merge operations till a max number of symbols is reached, or too infrequent symbols appear"""
         while len(self.symbols) < self.numsymbols:
             # Find most frequent pair
-            leftsymbol, rightsymbol = max(freqs, key=freqs.get)
+            pair = self._mostfrequentpair(freqs)
             # If most frequent is too infrequent, stop procedure
-            if freqs[(leftsymbol, rightsymbol)] < self.minfreq:
+            if pair is None or freqs[pair] < self.minfreq:
                 return corpus, freqs
+            leftsymbol, rightsymbol = pair
             # Merge symbols
             corpus, freqs, self.symbols = self.mergesymbols(
                 corpus,
@@ -243,12 +393,24 @@ class SubwordTokenizer:
         return corpus, freqs
 
     def fit(self, corpus):
-        # Cast corpus to list of linked-lists of symbols
-        corpus = [LinkedList(doc) for doc in corpus]
+        corpus = list(corpus)
         # Initialize symbols with chars
-        self.symbols = set(chain(*[doc for doc in corpus]))
+        self.symbols = _charset(corpus)
+        self.merges = []
+        self._wordchar_cache = {}
+        # Assign numeric ids to symbols, and mark those that can be joined with others
+        self._id2symbol = sorted(self.symbols)
+        self._symbol2id = {symbol: i for i, symbol in enumerate(self._id2symbol)}
+        self._joinable = np.array([self.crosswords or self._iswordsymbol(symbol) for symbol in self._id2symbol],
+                                  dtype=np.uint8)
+        # Cast corpus to linked-lists of symbol ids
+        corpus = ArenaList(_symbolids(corpus, self._symbol2id), [len(doc) for doc in corpus])
+        # Count occurrences of each symbol, to be updated in each merge
+        counts = np.bincount(corpus.values, minlength=len(self._id2symbol))
+        self._symbolcounts = collections.Counter(dict(zip(self._id2symbol, counts.tolist())))
         # Compute char pairs frequencies
         freqs = self.pairfreqs(corpus)
+        self._initheap(freqs)
         # Merge steps until maximum number of symbols reached
         finished = False
         while not finished:
@@ -256,22 +418,136 @@ class SubwordTokenizer:
             corpus, freqs = self.mergingrun(corpus, freqs)
             # Now prune the set to remove small symbols that might have been embedded in others
             beforeprune = len(self.symbols)
-            self.prunesymbols(corpus)
+            self.prunesymbols()
             afterprune = len(self.symbols)
             # If the prune was effective, try another merge run. Else finish the algorithm
             if beforeprune == afterprune:
                 finished = True
-        # Compile tokenizer for found symbols
-        self.compile()
+        # Release symbol ids and pairs heap, only needed for fitting
+        self._id2symbol = self._symbol2id = self._joinable = None
+        self._heap = self._pairorder = self._ordercounter = None
+        self._symbolcounts = None
+        # Rank merge operations by application order
+        self.mergerank = {}
+        self._mergeparts = {}
+        for rank, (leftsymbol, rightsymbol) in enumerate(self.merges):
+            self.mergerank.setdefault((leftsymbol, rightsymbol), rank)
+            self._mergeparts.setdefault(leftsymbol + rightsymbol, (leftsymbol, rightsymbol))
+        self._wordcache = {}
+        # Symbol matchers are only needed for longest match tokenization, so they are compiled on first use
+        self.detector = self.automaton = None
 
     def transform(self, text):
-        transformed = []
-        i = 0
-        while i < len(text):
-            symbol = self.bestmatch(text[i:])
-            transformed.append(symbol)
-            i += len(symbol)
-        return transformed
+        """Splits a text into symbols, replaying the merge operations learned while fitting
+
+        The text is split into characters, and then adjacent symbols are merged following the order in which those
+        merges were applied during fit, so the text is tokenized as the training corpus was. Symbols removed by
+        pruning are split back into the symbols they were built from.
+
+        If crosswords is disabled no symbol spans several words, so each word is tokenized independently and the
+        result cached. The cache is emptied whenever it gets full.
+
+        Characters not recognized as symbols are ignored.
+        """
+        if self.mergerank is None:
+            return self.longestmatch(text)
+        if self.crosswords:
+            return self._applymerges(text)
+        tokens = []
+        cache = self._wordcache
+        for word in _WORDS_RE.findall(text):
+            if word not in cache:
+                if len(cache) >= _WORDCACHESIZE:
+                    cache.clear()
+                cache[word] = self._applymerges(word)
+            tokens.extend(cache[word])
+        return tokens
+
+    def _applymerges(self, text):
+        """Splits a text into characters and merges them, lowest merge rank first
+
+        Candidate merges are kept in a heap of (rank, position) entries, so merges of the same rank are applied from
+        left to right, as in fit. Entries no longer matching the symbols at their position are discarded when popped.
+        """
+        mergerank = self.mergerank
+        symbols = list(text)
+        nxt = list(range(1, len(symbols))) + [-1]
+        prev = list(range(-1, len(symbols) - 1))
+        heap = [(mergerank[pair], i) for i, pair in enumerate(zip(symbols, symbols[1:])) if pair in mergerank]
+        heapq.heapify(heap)
+        while heap:
+            rank, i = heapq.heappop(heap)
+            j = nxt[i]
+            if symbols[i] is None or j == -1 or mergerank.get((symbols[i], symbols[j])) != rank:
+                continue
+            # Merge symbols
+            symbols[i] += symbols[j]
+            symbols[j] = None
+            nxt[i] = k = nxt[j]
+            if k != -1:
+                prev[k] = i
+            # Push merges with the new neighbours
+            for left, right in ((prev[i], i), (i, k)):
+                if left != -1 and right != -1:
+                    rank = mergerank.get((symbols[left], symbols[right]))
+                    if rank is not None:
+                        heapq.heappush(heap, (rank, left))
+        tokens = []
+        for symbol in symbols:
+            if symbol is not None:
+                tokens.extend(self._splitsymbol(symbol))
+        return tokens
+
+    def _splitsymbol(self, symbol):
+        """Splits a symbol into the symbols it was built from, until all of them are known symbols
+
+        Unknown characters are dropped.
+        """
+        if symbol in self.symbols:
+            return [symbol]
+        if symbol not in self._mergeparts:
+            return []
+        leftsymbol, rightsymbol = self._mergeparts[symbol]
+        return self._splitsymbol(leftsymbol) + self._splitsymbol(rightsymbol)
+
+    def longestmatch(self, text):
+        """Splits a text into symbols, taking the longest symbol at each position
+
+        Characters not recognized as symbols are ignored.
+        """
+        if self.automaton is None and self.detector is None:
+            self.compile()
+        if self.automaton is not None:
+            return [symbol for _, symbol in self.automaton.iter_long(text)]
+        return [match.group() for match in self.detector.finditer(text)]
+
+    def __getstate__(self):
+        """Symbol matchers are left out when pickling
+
+        Unpickling a regular expression compiles it again, and rebuilding an automaton is about as fast as
+        unpickling it, so there is no point in storing them. Instead they are compiled on first use. The cache of
+        transformed words is also left out.
+        """
+        state = self.__dict__.copy()
+        state["detector"] = None
+        state["automaton"] = None
+        state["_wordcache"] = {}
+        return state
+
+    def __setstate__(self, state):
+        """Restores a pickled tokenizer
+
+        Attributes missing in tokenizers pickled by older versions are given their default values, so those
+        tokenizers fall back to taking the longest symbol at each position.
+        """
+        self.detector = None
+        self.automaton = None
+        self.merges = None
+        self.mergerank = None
+        self._mergeparts = None
+        self._wordcache = {}
+        self._wordchar_cache = {}
+        self.__dict__.update(state)
 
     def __eq__(self, other):
         if not isinstance(other, SubwordTokenizer):
@@ -279,6 +555,126 @@ class SubwordTokenizer:
         return self.symbols == other.symbols
 
 
+def _symbolids(corpus, symbol2id):
+    """Transforms a corpus of documents into an array with the ids of all its characters, one document after another"""
+    # Translate codepoints to symbol ids through a lookup table
+    codepoints = _codepoints("".join(corpus))
+    lookup = np.zeros(int(codepoints.max()) + 1 if len(codepoints) else 0, dtype=np.int32)
+    lookup[[ord(char) for char in symbol2id]] = list(symbol2id.values())
+    return lookup[codepoints]
+
+
+@njit(cache=True)
+def _isjoinable(symbol, joinable):
+    """Checks whether a symbol id can be joined with others. Ids of composite symbols are always joinable"""
+    return symbol >= len(joinable) or joinable[symbol]
+
+
+@njit(cache=True)
+def _pair_freqs(values, nxt, joinable):
+    """Counts the pairs of joinable consecutive symbols in a corpus of linked lists of symbol ids
+
+    Returns arrays with the left symbols, right symbols and counts of each pair, sorted by first appearance.
+    """
+    index = dict()
+    lefts = []
+    rights = []
+    counts = []
+    for i in range(len(values)):
+        j = nxt[i]
+        if values[i] < 0 or j < 0:
+            continue
+        left = values[i]
+        right = values[j]
+        if not (_isjoinable(left, joinable) and _isjoinable(right, joinable)):
+            continue
+        key = (left, right)
+        if key in index:
+            counts[index[key]] += 1
+        else:
+            index[key] = len(counts)
+            lefts.append(left)
+            rights.append(right)
+            counts.append(1)
+    return (np.array(lefts, dtype=np.int32), np.array(rights, dtype=np.int32),
+            np.array(counts, dtype=np.int64))
+
+
+def _pair_freqs_packed(xp, values, nxt, joinable):
+    """Counts the pairs of joinable consecutive symbols using vectorized array operations
+
+    Each pair is packed in a single integer, and packed pairs are counted as unique values. Works both with numpy
+    and cupy arrays, with xp the corresponding module. Symbol ids must be smaller than 2**_PAIRBITS.
+
+    Returns arrays with the left symbols, right symbols and counts of each pair, sorted by first appearance.
+    """
+    maxid = int(values.max()) + 1 if len(values) else 0
+    if maxid > 2**_PAIRBITS:
+        raise ValueError("Symbol ids must be smaller than 2**%d to be packed in pairs" % _PAIRBITS)
+    valid = (values >= 0) & (nxt >= 0)
+    lefts = values[valid]
+    rights = values[nxt[valid]]
+    # Ids of composite symbols, beyond the joinable mask, are always joinable
+    isjoinable = xp.ones(max(maxid, len(joinable)), dtype=bool)
+    isjoinable[:len(joinable)] = joinable.astype(bool)
+    keep = isjoinable[lefts] & isjoinable[rights]
+    packed = (lefts[keep].astype(xp.int64) << _PAIRBITS) | rights[keep].astype(xp.int64)
+    pairs, first, counts = xp.unique(packed, return_index=True, return_counts=True)
+    order = xp.argsort(first)
+    pairs = pairs[order]
+    return (pairs >> _PAIRBITS).astype(xp.int32), (pairs & (2**_PAIRBITS - 1)).astype(xp.int32), counts[order]
+
+
+@njit(cache=True)
+def _merge_pair(values, nxt, prev, leftid, rightid, newid, joinable):
+    """Merges in place all occurrences of a pair of symbols in a corpus of linked lists of symbol ids
+
+    Merged positions take the new symbol id, while the positions of the right symbols are removed from the
+    lists and marked with a -1 value.
+
+    Returns the number of merges performed, and arrays with the left symbols, right symbols and frequency changes
+    of the neighbouring pairs affected by the merges, in order of appearance.
+    """
+    nmerges = 0
+    lefts = []
+    rights = []
+    deltas = []
+    for i in np.flatnonzero(values == leftid):
+        # The symbol might have been merged already as the right part of a previous occurrence
+        if values[i] != leftid:
+            continue
+        j = nxt[i]
+        if j < 0 or values[j] != rightid:
+            continue
+        # Join nodes
+        nmerges += 1
+        values[i] = newid
+        values[j] = -1
+        k = nxt[j]
+        nxt[i] = k
+        if k >= 0:
+            prev[k] = i
+        # Update frequencies with previous symbol
+        p = prev[i]
+        if p >= 0 and _isjoinable(values[p], joinable) and _isjoinable(newid, joinable):
+            lefts.append(values[p])
+            rights.append(newid)
+            deltas.append(1)
+            lefts.append(values[p])
+            rights.append(leftid)
+            deltas.append(-1)
+        # Update frequencies with next symbol
+        if k >= 0 and _isjoinable(values[k], joinable) and _isjoinable(newid, joinable):
+            lefts.append(newid)
+            rights.append(values[k])
+            deltas.append(1)
+            lefts.append(rightid)
+            rights.append(values[k])
+            deltas.append(-1)
+    return (nmerges, np.array(lefts, dtype=np.int32), np.array(rights, dtype=np.int32),
+            np.array(deltas, dtype=np.int64))
+
+
 """Dictionary of tokenizers indexed by a string"""
 TOKENIZERSBYNAME = {
     "char": CharTokenizer,
@@ -48,11 +48,8 @@ class Writer():
         Returns one piece of text at a time.
         """
         # Prepare seed
-        seedtokens = self.encoder.tokenizer.transform(seed)
         inputtokens = self.model.layers[0].input_shape[1]
-        if len(seedtokens) < inputtokens:
-            seedtokens = [NULL] * (inputtokens-len(seed)-1) + [START] + seedtokens
-        seedcoded = self.encoder.encodetokens(seedtokens[-inputtokens:])
+        seedcoded = self.encodeseed(seed, inputtokens)
         
         # Iterate generation
         while True:
@@ -71,6 +68,66 @@ class Writer():
                     seedcoded = self.encoder.encodetokens(restart)
                     break
             
+    def writebatch(self, seeds, length=1000):
+        """Start writing characters for several texts at once
+
+        Arguments:
+            seeds: list of texts to initialize generation, one per text to generate
+            length: length of the generated texts
+
+        Returns an iterator over lists of tokens, one token per text.
+        """
+        return itertools.islice(self.generatebatch(seeds), length)
+
+    def generatebatch(self, seeds):
+        """Infinite generator of several texts following the Writer style.
+
+        All texts are generated in parallel, running the model once per step
+        over a batch with the current inputs of every text. Beam search is not
+        used: each new token is drawn directly from the model probabilities.
+
+        Arguments:
+            seeds: list of texts to initialize generation, one per text to generate
+
+        Returns a list with a new token for each text at a time.
+        """
+        # Prepare seeds
+        inputtokens = self.model.layers[0].input_shape[1]
+        seedscoded = np.stack([self.encodeseed(seed, inputtokens) for seed in seeds])
+        restart = self.encoder.encodetokens([NULL] * (inputtokens-1) + [START])
+
+        # Iterate generation
+        while True:
+            # Predict token probabilities for all texts at once
+            probs = self.model.predict(seedscoded, verbose=0)
+            newcodes = np.array([self.drawtoken(p) for p in probs])
+            # Drop oldest tokens, add new ones
+            seedscoded = np.concatenate([seedscoded[:, 1:], newcodes[:, np.newaxis]], axis=1)
+            newtokens = [self.encoder.index2char[code] for code in newcodes]
+            # If generated end token, restart seed of that text
+            for i, token in enumerate(newtokens):
+                if token == END:
+                    seedscoded[i] = restart
+            yield newtokens
+
+    def encodeseed(self, seed, inputtokens):
+        """Encodes a seed text as model input, padding it if shorter than the number of input tokens"""
+        seedtokens = self.encoder.tokenizer.transform(seed)
+        if len(seedtokens) < inputtokens:
+            seedtokens = [NULL] * (inputtokens-len(seedtokens)-1) + [START] + seedtokens
+        return self.encoder.encodetokens(seedtokens[-inputtokens:])
+
+    def drawtoken(self, probs):
+        """Draws the index of a token from a vector of token probabilities
+
+        If no creativity has been configured, just draw the most probable token.
+        If creativity has been configured, draw with random sampling.
+        """
+        if self.creativity == 0:
+            return int(np.argmax(probs))
+        else:
+            return sample(np.log(probs), self.creativity)
+
     def beamsearch(self, seedcoded):
         """Generates token predictions using a beam search algorithm
         
@@ -89,14 +146,17 @@ class Writer():
         candidates = self.drawcandidates(newcandidates, self.beamsize)
         # Beam depth extension steps
         for _ in range(1, self.batchsize):
+            # Update seed with each candidate tokens
+            # Also drop tokens if longer than necessary
+            candseeds = np.array([
+                np.append(seedcoded[len(tokens):], tokens)[:maxlen]
+                for _, tokens in candidates
+            ])
+            # Predictions for next token, for all candidates at once
+            candprobs = self.model.predict(candseeds, verbose=0)
             # Extend each candidate
             newcandidates = []
-            for logprob, tokens in candidates:
-                # Update seed with candidate tokens
-                # Also drop tokens if longer than necessary
-                candseed = np.append(seedcoded[len(tokens):], tokens)[:maxlen]
-                # Predictions for next token
-                probs = self.model.predict(np.array([candseed]), verbose=0)[0]
+            for (logprob, tokens), probs in zip(candidates, candprobs):
                 # Add to pool of next round tokens
                 newcandidates.extend([
                     (logprob + np.log(p), tokens + [idx])
@@ -30,3 +30,18 @@ def test_consistent_encoding():
     encoder2 = Encoder(corpus2)
 
     assert encoder1 == encoder2
+
+
+def test_patterngenerator_sparse_targets():
+    """The patterns generator produces token indexes both as inputs and as targets"""
+    text = "For the glory of mankind"
+    encoder = Encoder([text])
+    coded = encoder.encodetext(text)
+
+    X, y = next(encoder.patterngenerator([text], tokensperpattern=4, batchsize=len(text)))
+
+    print("Inputs shape", X.shape)
+    print("Targets", y)
+    assert X.shape == (len(text), 4)
+    assert y.shape == (len(text), 1)
+    assert list(y[:, 0]) == list(coded)
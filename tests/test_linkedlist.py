@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for the linked lists module
+
+@author: Álvaro Barbero Jiménez
+"""
+
+from neurowriter.linkedlist import ArenaList
+
+
+def test_ArenaList_build():
+    """An arena of lists is built with the expected links between nodes"""
+    arena = ArenaList([1, 2, 3, 4, 5], [2, 0, 3])
+
+    assert list(arena) == [1, 2, 3, 4, 5]
+    assert list(arena.nxt) == [1, -1, 3, 4, -1]
+    assert list(arena.prev) == [-1, 0, -1, 2, 3]
+
+
+def test_ArenaList_merge():
+    """Merging nodes in an arena of lists removes the merged nodes and updates links"""
+    arena = ArenaList([1, 2, 3, 4, 5], [2, 3])
+    arena.mergewithnext(2, 7)
+    arena.mergewithnext(0, 8)
+
+    assert list(arena) == [8, 7, 5]
+    assert list(arena.iternodes()) == [0, 2, 4]
+    assert len(arena) == 3
+    assert arena.nxt[0] == -1
+    assert arena.nxt[2] == 4
+    assert arena.prev[4] == 2
@@ -8,12 +8,23 @@ Tests for the models creation module.
 @author: Álvaro Barbero Jiménez
 """
 
+import os
+import pytest
+from tempfile import NamedTemporaryFile
 import tensorflow as tf
 import numpy as np
 from keras import backend
+from keras.models import Model, load_model
+from keras.layers import Input, Conv1D, Activation, add, multiply, LSTM, CuDNNLSTM
+from tensorflow.core.protobuf import rewriter_config_pb2
 
-from neurowriter.models import get_available_gpus, tensorslice
+from neurowriter.encoding import Encoder
+from neurowriter.symbols import START, NULL
+
+from neurowriter.models import get_available_gpus, lstmlayer, configure_session, XLAENV, MIXEDPRECISIONENV
+from neurowriter.models import calibrationpatterns, quantize, _inferenceconfig, GatedMerge, CUSTOMOBJECTS
 from neurowriter.models import CNNLSTMModel, LSTMModel, StackedLSTMModel, WavenetModel, DilatedConvModel
+from neurowriter.models import PerceptronModel
 
 
 def test_getgpus():
@@ -22,65 +33,162 @@ def test_getgpus():
     assert isinstance(gpus, list)
 
 
-def test_tensorslice_normal():
-    """Tensor slicing is performed correctly for data > slices"""
-    data = np.array([
-        [[1, 1, 1], [1, 1, 1], [1, 1, 1]],
-        [[2, 2, 2], [2, 2, 2], [2, 2, 2]],
-        [[3, 3, 3], [3, 3, 3], [3, 3, 3]],
-        [[4, 4, 4], [4, 4, 4], [4, 4, 4]],
-        [[5, 5, 5], [5, 5, 5], [5, 5, 5]],
-        [[6, 6, 6], [6, 6, 6], [6, 6, 6]]
-    ])
-    datatensor = tf.constant(data)
-    
-    tests = [
-        (1, [data]),
-        (2, [data[0:3], data[3:6]]),
-        (3, [data[0:2], data[2:4], data[4:6]]),
-        (6, [data[0:1], data[1:2], data[2:3],
-             data[3:4], data[4:5], data[5:6]])
-    ]
-    
-    # We need a tensor flow session to run the graph
-    sess = tf.Session()
-    
-    for nslices, expected in tests:
-        obtained = [sess.run(tensorslice(datatensor, i, nslices)) for i in range(nslices)]
-        print("nslices:", nslices)
-        print("Expected:", expected)
-        print("Obtained:", obtained)
-        assert(np.allclose(obtained, expected))
-
-
-def test_tensorslice_small():
-    """Tensor slicing is performed correctly for data < slices"""
-    data = np.array([
-        [[1, 1, 1], [1, 1, 1], [1, 1, 1]],
-        [[2, 2, 2], [2, 2, 2], [2, 2, 2]],
-        [[3, 3, 3], [3, 3, 3], [3, 3, 3]]
-    ])
-    datatensor = tf.constant(data)
-
-    nulldata = np.zeros([0, 3, 3])
-    tests = [
-        (4, [nulldata, data[0:1], data[1:2], data[2:3]]),
-        (5, [nulldata, data[0:1], nulldata, data[1:2], data[2:3]]),
-        (10, [nulldata, nulldata, nulldata, data[0:1], nulldata,
-              nulldata, data[1:2], nulldata, nulldata,data[2:3]])
-    ]
-    
-    # We need a tensor flow session to run the graph
-    sess = tf.Session()
-    
-    for nslices, expected in tests:
-        obtained = [sess.run(tensorslice(datatensor, i, nslices)) for i in range(nslices)]
-        print("nslices:", nslices)
-        print("Expected:", expected)
-        print("Obtained:", obtained)
+def test_lstmlayer():
+    """LSTM layers use cuDNN when requested, and cuDNN-compatible gates otherwise"""
+    layer = lstmlayer(4, False, return_sequences=True)
+    assert(isinstance(layer, LSTM))
+    assert(layer.recurrent_activation.__name__ == 'sigmoid')
+    assert(layer.activation.__name__ == 'tanh')
+    assert(layer.return_sequences)
+    assert(isinstance(lstmlayer(4, True), CuDNNLSTM))
+
+
+def test_configure_session_xla():
+    """XLA compilation is configured in the keras session only when requested through the environment"""
+    os.environ[XLAENV] = "1"
+    try:
+        configure_session()
+        config = backend.get_session()._config
+        assert config.graph_options.optimizer_options.global_jit_level == tf.OptimizerOptions.ON_1
+    finally:
+        del os.environ[XLAENV]
+        backend.clear_session()
+
+
+def test_configure_session_noxla():
+    """Models not supporting XLA get a session without XLA, even after a session with XLA was configured"""
+    os.environ[XLAENV] = "1"
+    try:
+        configure_session()
+        xlasession = backend.get_session()
+        configure_session(xla=False)
+        config = backend.get_session()._config
+        assert config.graph_options.optimizer_options.global_jit_level != tf.OptimizerOptions.ON_1
+        assert xlasession._closed
+    finally:
+        del os.environ[XLAENV]
+        backend.clear_session()
+
+
+def test_configure_session_mixedprecision():
+    """Automatic mixed precision is configured in the keras session only when requested through the environment"""
+    os.environ[MIXEDPRECISIONENV] = "1"
+    try:
+        configure_session(xla=False)
+        config = backend.get_session()._config
+        assert config.graph_options.rewrite_options.auto_mixed_precision == rewriter_config_pb2.RewriterConfig.ON
+        assert config.graph_options.optimizer_options.global_jit_level != tf.OptimizerOptions.ON_1
+    finally:
+        del os.environ[MIXEDPRECISIONENV]
+        backend.clear_session()
+
+
+def test_create_keeps_session():
+    """Building a model does not replace the keras session, even if graph optimizations are requested"""
+    os.environ[MIXEDPRECISIONENV] = "1"
+    try:
+        session = backend.get_session()
+        LSTMModel.create(inputtokens=8, vocabsize=10)
+        assert backend.get_session() is session
+    finally:
+        del os.environ[MIXEDPRECISIONENV]
+        backend.clear_session()
+
+
+def test_calibrationpatterns():
+    """Calibration patterns are spread over the whole corpus and are not made mostly of padding"""
+    corpus = ["abcdefgh" * 20, "ijklmnop" * 20]
+    encoder = Encoder(corpus)
+    padding = [encoder.char2index[NULL], encoder.char2index[START]]
+
+    patterns = list(calibrationpatterns(encoder, corpus, inputtokens=8, samples=5))
+    texts = [encoder.decodeindexes(X[0]) for X in patterns]
+    print("Obtained", texts)
+    assert(len(patterns) == 5)
+    assert(all(np.isin(X, padding).mean() < 0.5 for X in patterns))
+    assert(any("i" in text for text in texts))
+
+
+def test_inferenceconfig():
+    """cuDNN LSTM layers are replaced by unrolled standard LSTM layers when preparing a model for inference"""
+    config = {"layers": [
+        {"class_name": "Bidirectional", "config": {"layer": {"class_name": "CuDNNLSTM", "config": {"units": 4}}}},
+        {"class_name": "LSTM", "config": {"units": 4, "activation": "tanh"}},
+        {"class_name": "Dense", "config": {"units": 4}},
+    ]}
+    expected = {"layers": [
+        {"class_name": "Bidirectional", "config": {"layer": {"class_name": "LSTM", "config": {
+            "units": 4, "activation": "tanh", "recurrent_activation": "sigmoid", "unroll": True}}}},
+        {"class_name": "LSTM", "config": {"units": 4, "activation": "tanh", "unroll": True}},
+        {"class_name": "Dense", "config": {"units": 4}},
+    ]}
+    obtained = _inferenceconfig(config)
+    print("Expected", expected)
+    print("Obtained", obtained)
+    assert(obtained == expected)
+
+
+@pytest.mark.skipif(not hasattr(tf, "lite"), reason="TensorFlow Lite not available")
+def test_quantize():
+    """A small model can be quantized and run with the TensorFlow Lite interpreter"""
+    corpus = ["abcdefgh" * 10, "ijklmnop" * 10]
+    encoder = Encoder(corpus)
+    try:
+        model = PerceptronModel.create(inputtokens=8, vocabsize=encoder.nchars)
+        flatbuffer = quantize(model, encoder, corpus, samples=10)
+        interpreter = tf.lite.Interpreter(model_content=flatbuffer)
+        interpreter.allocate_tensors()
+        inputdetails = interpreter.get_input_details()[0]
+        X = next(calibrationpatterns(encoder, corpus, inputtokens=8, samples=1))
+        interpreter.set_tensor(inputdetails["index"], X.astype(inputdetails["dtype"]))
+        interpreter.invoke()
+        probs = interpreter.get_tensor(interpreter.get_output_details()[0]["index"])
+        print("Obtained", probs)
+        assert(probs.shape == (1, encoder.nchars))
+    finally:
+        backend.clear_session()
+
+
+def test_gatedmerge_equivalent():
+    """The GatedMerge layer computes the same as the gated activation, projection and residual layers it replaces"""
+    steps, kernels = 5, 3
+    normal = Input(shape=(steps, kernels))
+    gate = Input(shape=(steps, kernels))
+    residual = Input(shape=(steps, kernels))
+    try:
+        # Replaced subgraph
+        merged = multiply([Activation('tanh')(normal), Activation('sigmoid')(gate)])
+        projection = Conv1D(kernels, 1, activation='tanh')
+        skip = projection(merged)
+        reference = Model(inputs=[normal, gate, residual], outputs=[add([skip, residual]), skip])
+        # Fused layer, with the same weights
+        fused = GatedMerge(kernels)
+        fusedmodel = Model(inputs=[normal, gate, residual], outputs=fused([normal, gate, residual]))
+        kernel, bias = projection.get_weights()
+        fused.set_weights([kernel[0], bias])
+
+        X = [np.random.randn(4, steps, kernels) for _ in range(3)]
+        expected = reference.predict(X)
+        obtained = fusedmodel.predict(X)
         for x, y in zip(obtained, expected):
-            assert(x.shape == y.shape)
-            assert(np.allclose(x, y))
+            assert(np.allclose(x, y, atol=1e-6))
+    finally:
+        backend.clear_session()
+
+
+def test_wavenet_save_load():
+    """Wavenet models can be saved and loaded back with their custom layers"""
+    try:
+        model = WavenetModel.create(inputtokens=8, vocabsize=10, kernels=4)
+        X = np.random.randint(0, 10, size=(4, 8))
+        expected = model.predict(X)
+        with NamedTemporaryFile(suffix=".h5") as modelfile:
+            model.save(modelfile.name)
+            loaded = load_model(modelfile.name, custom_objects=CUSTOMOBJECTS)
+        obtained = loaded.predict(X)
+        assert(np.allclose(obtained, expected, atol=1e-6))
+    finally:
+        backend.clear_session()
 
 
 def model_build_checks(modelclass, paramsets):
@@ -6,7 +6,11 @@ Tests for the optimizer module.
 @author: Álvaro Barbero Jiménez
 """
 
-from neurowriter.optimizer import chekpointappend, checkpointload, hypertrain
+import numpy as np
+from keras import backend
+from keras.optimizers import SGD
+
+from neurowriter.optimizer import chekpointappend, checkpointload, hypertrain, lossscaled
 from neurowriter.models import PerceptronModel, SmallWavenet
 from neurowriter.corpus import Corpus
 from neurowriter.encoding import Encoder
@@ -40,6 +44,20 @@ def test_checkpoint():
         assert(y0 == losses)
 
 
+def test_lossscaled():
+    """An optimizer with loss scaling computes the same gradients as the original optimizer"""
+    try:
+        x = backend.variable(np.array([1e-3, 2.0, -3.0]))
+        loss = backend.sum(x ** 2)
+        expected = backend.eval(SGD().get_gradients(loss, [x])[0])
+        obtained = backend.eval(lossscaled(SGD(), scale=1024).get_gradients(loss, [x])[0])
+        print("Expected", expected)
+        print("Obtained", obtained)
+        assert(np.allclose(obtained, expected))
+    finally:
+        backend.clear_session()
+
+
 def test_hypertrain_run():
     """A small hypertraining procedure can be run"""
     modelclass = PerceptronModel
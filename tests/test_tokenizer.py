@@ -8,10 +8,14 @@ Tests for the tokenizer module
 @author: Álvaro Barbero Jiménez
 """
 
+import pickle
 import random
 import string
 import time
+import numpy as np
 
+from neurowriter import tokenizer
+from neurowriter.linkedlist import ArenaList
 from neurowriter.tokenizer import WordTokenizer, SubwordTokenizer
 
 
@@ -108,7 +112,8 @@ def test_SubwordTokenizerTransform():
     tok.fit(train)
     
     test = "aaabababaabcdabaa"
-    expected = ["aaab", "ab", "ab", "a", "ab", "c", "d", "ab", "a", "a"]
+    # Merges are (a,a), (a,b), (aa,ab), so "aab" is split as "aa" "b", and the pruned "aa" back into "a" "a"
+    expected = ["aaab", "ab", "ab", "a", "a", "b", "c", "d", "ab", "a", "a"]
     
     obtained = tok.transform(test)
     print("Expected", expected)
@@ -116,6 +121,191 @@ def test_SubwordTokenizerTransform():
     assert(obtained == expected)
 
 
+def test_SubwordTokenizerTransformWords():
+    """The subword tokenizer transforms texts with several words as when fitting"""
+    train = ["ab ab, aab. abab abab"]
+    tok = SubwordTokenizer(numsymbols=1024, minfreq=2)
+    tok.fit(train)
+
+    test = "abab, ab aab"
+    expected = ["abab", ",", " ", "ab", " ", "a", "ab"]
+
+    obtained = tok.transform(test)
+    print("Expected", expected)
+    print("Obtained", obtained)
+    assert(obtained == expected)
+
+
+def test_SubwordTokenizerWordCacheBounded():
+    """The cache of transformed words of the subword tokenizer does not grow beyond its maximum size"""
+    train = ["ab ab, aab. abab abab"]
+    tok = SubwordTokenizer(numsymbols=1024, minfreq=2)
+    tok.fit(train)
+    test = " ".join("ab" * i for i in range(1, 20))
+    expected = tok.transform(test)
+
+    cachesize = tokenizer._WORDCACHESIZE
+    tokenizer._WORDCACHESIZE = 4
+    try:
+        tok._wordcache = {}
+        obtained = tok.transform(test)
+        cached = len(tok._wordcache)
+    finally:
+        tokenizer._WORDCACHESIZE = cachesize
+    print("Cached words", cached)
+    assert(cached <= 4)
+    assert(obtained == expected)
+
+
+def test_SubwordTokenizerLongestmatch():
+    """The subword tokenizer can also split a text taking the longest symbol at each position"""
+    train = ["aaababdaaabcab"]
+    tok = SubwordTokenizer(numsymbols=1024, minfreq=2)
+    tok.fit(train)
+
+    test = "aaabababaabcdabaa"
+    expected = ["aaab", "ab", "ab", "a", "ab", "c", "d", "ab", "a", "a"]
+
+    obtained = tok.longestmatch(test)
+    print("Expected", expected)
+    print("Obtained", obtained)
+    assert(obtained == expected)
+
+
+def test_SubwordTokenizerTransformUnknown():
+    """The subword tokenizer ignores characters not seen during training"""
+    train = ["aaababdaaabcab"]
+    tok = SubwordTokenizer(numsymbols=1024, minfreq=2)
+    tok.fit(train)
+
+    test = "aaabxabzc"
+    expected = ["aaab", "ab", "c"]
+
+    obtained = tok.transform(test)
+    print("Expected", expected)
+    print("Obtained", obtained)
+    assert(obtained == expected)
+
+
+def test_SubwordTokenizerBestmatch():
+    """The subword tokenizer finds the longest symbol at a given position of a string"""
+    train = ["aaababdaaabcab"]
+    tok = SubwordTokenizer(numsymbols=1024, minfreq=2)
+    tok.fit(train)
+
+    text = "xaaabcab"
+    tests = [(0, None), (1, "aaab"), (2, "a"), (5, "c"), (6, "ab")]
+    for pos, expected in tests:
+        obtained = tok.bestmatch(text, pos)
+        print("Position", pos, "expected", expected, "obtained", obtained)
+        assert(obtained == expected)
+
+
+def test_SubwordTokenizerRegexFallback():
+    """The subword tokenizer obtains the same results when matching symbols with a regular expression"""
+    train = ["aaababdaaabcab"]
+    tok = SubwordTokenizer(numsymbols=1024, minfreq=2)
+    tok.fit(train)
+    test = "aaabababaabcdabaaxb"
+    expected = tok.longestmatch(test)
+
+    automatonmodule = tokenizer.ahocorasick
+    tokenizer.ahocorasick = None
+    try:
+        tok.compile()
+        obtained = tok.longestmatch(test)
+    finally:
+        tokenizer.ahocorasick = automatonmodule
+    print("Expected", expected)
+    print("Obtained", obtained)
+    assert(obtained == expected)
+
+
+def test_SubwordTokenizerMissingChars():
+    """The subword tokenizer takes the longest symbols even if some characters are not symbols by themselves"""
+    tok = SubwordTokenizer()
+    tok.symbols = {"b", "a", "aa", "cbb", "accb", "ccbb", "caaa"}
+    tok.compile()
+    test = "axcbbca"
+    expected = ["a", "cbb", "a"]
+
+    obtained = tok.longestmatch(test)
+    print("Expected", expected)
+    print("Obtained", obtained)
+    assert(obtained == expected)
+    assert(tok.bestmatch(test, 6) == "a")
+
+
+def test_SubwordTokenizerPickle():
+    """A pickled subword tokenizer leaves out its symbol matchers, and rebuilds them on first use"""
+    train = ["aaababdaaabcab"]
+    tok = SubwordTokenizer(numsymbols=1024, minfreq=2)
+    tok.fit(train)
+    test = "aaabababaabcdabaa"
+
+    loaded = pickle.loads(pickle.dumps(tok))
+    assert(loaded.detector is None and loaded.automaton is None)
+    assert(loaded == tok)
+    assert(loaded.transform(test) == tok.transform(test))
+
+
+def test_SubwordTokenizerPickleOld():
+    """A subword tokenizer pickled without matchers nor merges falls back to taking the longest symbols"""
+    train = ["aaababdaaabcab"]
+    tok = SubwordTokenizer(numsymbols=1024, minfreq=2)
+    tok.fit(train)
+    test = "aaabababaabcdabaa"
+    expected = tok.longestmatch(test)
+
+    for attribute in ["detector", "automaton", "merges", "mergerank", "_mergeparts", "_wordcache"]:
+        delattr(tok, attribute)
+    loaded = pickle.loads(pickle.dumps(tok))
+    obtained = loaded.transform(test)
+    print("Expected", expected)
+    print("Obtained", obtained)
+    assert(obtained == expected)
+    assert(loaded.bestmatch(test) == "aaab")
+
+
+def test_SubwordTokenizerNotFitted():
+    """A subword tokenizer cannot transform texts before being fitted"""
+    tok = SubwordTokenizer()
+    try:
+        tok.transform("abc")
+        assert False
+    except ValueError:
+        pass
+
+
+def test_pairfreqs_packed():
+    """Pair statistics computed with vectorized array operations match those of the pair counting kernel"""
+    rng = np.random.RandomState(0)
+    maxid = 2**tokenizer._PAIRBITS
+    # Few distinct ids, some of them close to the maximum allowed, so pairs are repeated
+    ids = np.array([0, 1, 2, 3, 4, 5, maxid - 3, maxid - 2, maxid - 1])
+    for _ in range(10):
+        values = rng.choice(ids, size=200)
+        corpus = ArenaList(values, [50, 0, 100, 50])
+        for i in rng.choice(200, size=20, replace=False):
+            if corpus.values[i] >= 0 and corpus.nxt[i] >= 0:
+                corpus.mergewithnext(i, rng.choice(ids))
+        joinable = rng.randint(0, 2, size=4).astype(np.uint8)
+        expected = tokenizer._pair_freqs(corpus.values, corpus.nxt, joinable)
+        obtained = tokenizer._pair_freqs_packed(np, corpus.values, corpus.nxt, joinable)
+        for x, y in zip(obtained, expected):
+            assert(np.array_equal(x, y))
+
+
+def test_pairfreqs_packed_overflow():
+    """Pair statistics cannot be computed with packed pairs if symbol ids do not fit"""
+    corpus = ArenaList([0, 2**tokenizer._PAIRBITS, 1])
+    try:
+        tokenizer._pair_freqs_packed(np, corpus.values, corpus.nxt, np.ones(2, dtype=np.uint8))
+        assert False
+    except ValueError:
+        pass
+
+
 def test_SubwordTokenizerTimes():
     """Performs some runtime tests on the subword tokenizer"""
     n = 10000
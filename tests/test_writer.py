@@ -16,10 +16,17 @@ from neurowriter.tokenizer import CharTokenizer
 from neurowriter.corpus import Corpus
 
 
+class MockLayer():
+    """Mock input layer"""
+    input_shape = (None, 2)
+
+
 class MockModel():
     """Mock model for beam search tests"""
+    layers = [MockLayer()]
+
     def predict(self, X, **kwargs):
-        return [[0.5, 0.3, 0.2]]
+        return [[0.5, 0.3, 0.2]] * len(X)
 
 
 def test_writer_beamsearch():
@@ -51,3 +58,18 @@ def test_writer_beamsearch_long():
     print("Expected", expected)
     print("Obtained", obtained)
     assert obtained == expected
+
+
+def test_writer_generatebatch():
+    """Batched generation produces one token per seed at each step"""
+    mockmodel = MockModel()
+    corpus = Corpus(["abc"])
+    encoder = Encoder(corpus=corpus, tokenizer=CharTokenizer())
+    writer = Writer(mockmodel, encoder, creativity=0)
+    seeds = ["a", "bc", "cab"]
+
+    expected = [[encoder.index2char[0]] * len(seeds)] * 4
+    obtained = list(writer.writebatch(seeds, length=4))
+    print("Expected", expected)
+    print("Obtained", obtained)
+    assert obtained == expected